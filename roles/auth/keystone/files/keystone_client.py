@@ -1,13 +1,28 @@
 #!/usr/bin/env python
 
+import collections
+import errno
+import functools
+import hashlib
 import os.path
 import requests
 import sys
 import json
+import mmap
+import struct
+import tempfile
+import threading
+import time
+import zlib
 
 from argparse import ArgumentParser
 from datetime import datetime
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 __author__ = "Lisa Zangrando"
 __email__ = "lisa.zangrando[AT]pd.infn.it"
 __copyright__ = """Copyright (c) 2015 INFN - INDIGO-DataCloud
@@ -27,6 +42,253 @@ See the License for the specific language governing
 permissions and limitations under the License."""
 
 
+# monotonic clock if available, so that deadlines survive wall clock changes
+_clock = getattr(time, "monotonic", time.time)
+
+
+class DeadlineExceeded(Exception):
+
+    def __init__(self, message, timed_out=False):
+        super(DeadlineExceeded, self).__init__(message)
+        # True if raised by a request actually timed out, False if the
+        # budget was already spent before sending any request
+        self.timed_out = timed_out
+
+
+class Deadline(object):
+    """Overall time budget (in seconds) of a single logical operation.
+
+    Each HTTP call performed on behalf of the operation gets only what is
+    left of the budget, so the nested calls can never exceed it as a whole.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = _clock() + budget
+
+    def remaining(self):
+        return self.expires_at - _clock()
+
+    def isExpired(self):
+        return self.remaining() <= 0
+
+    def getTimeout(self, timeout=None):
+        remaining = self.remaining()
+
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline of %ss exceeded!" % self.budget)
+
+        if timeout is None or timeout > remaining:
+            return remaining
+
+        return timeout
+
+
+class AuthenticationBackoff(Exception):
+    pass
+
+
+class FailureCache(object):
+    """Short-lived cache of the authentication failures, shared on disk.
+
+    A failed password authentication (wrong credentials or Keystone not
+    available) is recorded in a small file named after the credentials key.
+    Until its exponential backoff expires, any process using the same
+    credentials fails fast with the recorded error instead of contacting
+    Keystone again. Once expired, the first process that checks the entry
+    pushes it forward by the current backoff and probes Keystone, while the
+    others keep failing fast.
+
+    The cache is best-effort: if the directory cannot be used (e.g. a
+    read-only home) a warning is printed and the cache gets disabled.
+    """
+
+    def __init__(self, directory, min_backoff=1, max_backoff=300):
+        self.directory = directory
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.enabled = True
+
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                self._disable(ex)
+
+    @staticmethod
+    def getKey(*items):
+        data = "\0".join("%s" % item for item in items)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def isCacheable(ex):
+        if isinstance(ex, requests.exceptions.HTTPError):
+            status = ex.response.status_code
+            return status in (401, 403, 429) or status >= 500
+
+        # a deadline spent on the client side says nothing about Keystone
+        if isinstance(ex, DeadlineExceeded):
+            return ex.timed_out
+
+        return isinstance(ex, (requests.exceptions.ConnectionError,
+                               requests.exceptions.Timeout))
+
+    def check(self, key):
+        if not self.enabled:
+            return
+
+        try:
+            self._check(key)
+        except (IOError, OSError) as ex:
+            self._disable(ex)
+
+    def failure(self, key, error):
+        if not self.enabled:
+            return
+
+        try:
+            self._failure(key, error)
+        except (IOError, OSError) as ex:
+            self._disable(ex)
+
+    def success(self, key):
+        if not self.enabled:
+            return
+
+        try:
+            self._success(key)
+        except (IOError, OSError) as ex:
+            self._disable(ex)
+
+    def _disable(self, ex):
+        self.enabled = False
+        sys.stderr.write("WARNING: authentication failure cache disabled: "
+                         "%s\n" % ex)
+
+    def _check(self, key):
+        filename = self._getFilename(key)
+
+        if not os.path.isfile(filename):
+            return
+
+        with self._lock():
+            entry = self._load(filename)
+
+            if entry is None:
+                return
+
+            now = time.time()
+
+            if entry["retry_at"] > now:
+                raise AuthenticationBackoff("%s (retry in %ds)"
+                                            % (entry["error"],
+                                               entry["retry_at"] - now + 1))
+
+            # claim the retry: the others keep failing fast meanwhile
+            entry["retry_at"] = now + entry["backoff"]
+            self._save(filename, entry)
+
+    def _failure(self, key, error):
+        filename = self._getFilename(key)
+
+        with self._lock():
+            entry = self._load(filename) or {"failures": 0}
+
+            entry["failures"] += 1
+            entry["backoff"] = min(self.max_backoff,
+                                   self.min_backoff *
+                                   2 ** (entry["failures"] - 1))
+            entry["retry_at"] = time.time() + entry["backoff"]
+            entry["error"] = "%s" % error
+
+            self._save(filename, entry)
+
+    def _success(self, key):
+        filename = self._getFilename(key)
+
+        if not os.path.isfile(filename):
+            return
+
+        with self._lock():
+            try:
+                os.remove(filename)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+    def _getFilename(self, key):
+        return os.path.join(self.directory, ".auth_failure_%s" % key)
+
+    def _lock(self):
+        # a single lock for the whole directory, so that no lock file is
+        # left behind for each credentials key
+        return _FileLock(os.path.join(self.directory, ".auth_failure.lock"))
+
+    def _load(self, filename):
+        try:
+            with open(filename, "r") as f:
+                return json.load(f)
+        # a missing or truncated entry is like no entry at all
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, filename, entry):
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+
+            os.rename(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+class _FileLock(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.filename, "a")
+
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+
+        return self
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+
+        self.f.close()
+        self.f = None
+
+
+def operation(method):
+    """Runs a public KeystoneClient method within the client's deadline.
+
+    The deadline is started by the outermost operation only: any operation
+    invoked from inside it (e.g. authenticate() from validateToken()) shares
+    the same budget. A deadline of None or <= 0 disables it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.deadline is None or self.deadline <= 0 or \
+                self._getDeadline() is not None:
+            return method(self, *args, **kwargs)
+
+        self._local.deadline = Deadline(self.deadline)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.deadline = None
+
+    return wrapper
+
+
 class Token(object):
 
     def __init__(self, token, data):
@@ -93,19 +355,19 @@ class Token(object):
     def save(self, filename):
         # save to file
         with open(filename, 'w') as f:
-            token = {}
-            token["catalog"] = self.catalog
-            token["extras"] = self.extras
-            token["user"] = self.user
-            token["project"] = self.project
-            token["roles"] = self.roles
-            token["roles"] = self.roles
-            token["issued_at"] = self.issued_at.isoformat()
-            token["expires_at"] = self.expires_at.isoformat()
+            json.dump(self.toDict(), f)
 
-            data = {"id": self.id, "token": token}
+    def toDict(self):
+        token = {}
+        token["catalog"] = self.catalog
+        token["extras"] = getattr(self, "extras", {})
+        token["user"] = self.user
+        token["project"] = self.project
+        token["roles"] = self.roles
+        token["issued_at"] = self.issued_at.isoformat()
+        token["expires_at"] = self.expires_at.isoformat()
 
-            json.dump(data, f)
+        return {"id": self.id, "token": token}
 
     @classmethod
     def load(cls, filename):
@@ -145,7 +407,8 @@ class Token(object):
     by the trustor. The trustor is also often the trustee in living trusts.
     """
     def trust(self, trustee_user, expires_at=None,
-              project_id=None, roles=None, impersonation=True):
+              project_id=None, roles=None, impersonation=True,
+              timeout=None, ca_cert=None, session=None):
         if self.isExpired():
             raise Exception("token expired!")
 
@@ -178,11 +441,17 @@ class Token(object):
         if "v2.0" in endpoint["url"]:
             endpoint["url"] = endpoint["url"].replace("v2.0", "v3")
 
-        response = requests.post(url=endpoint["url"] + "/OS-TRUST/trusts",
-                                 headers=headers,
-                                 data=json.dumps(data))
+        if session is None:
+            session = requests
 
-        if response.status_code != requests.codes.ok:
+        response = session.post(url=endpoint["url"] + "/OS-TRUST/trusts",
+                                headers=headers,
+                                data=json.dumps(data),
+                                timeout=timeout,
+                                verify=ca_cert)
+
+        if response.status_code not in (requests.codes.ok,
+                                        requests.codes.created):
             response.raise_for_status()
 
         if not response.text:
@@ -191,6 +460,59 @@ class Token(object):
         return Trust(response.json())
 
 
+class Trust(object):
+
+    def __init__(self, data):
+        data = data["trust"]
+        self.id = data["id"]
+        self.impersonation = data["impersonation"]
+        self.project_id = data["project_id"]
+        self.roles = data["roles"]
+        self.trustee_user_id = data["trustee_user_id"]
+        self.trustor_user_id = data["trustor_user_id"]
+        self.expires_at = None
+
+        if data.get("expires_at"):
+            self.expires_at = datetime.strptime(data["expires_at"],
+                                                "%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def getExpiration(self):
+        return self.expires_at
+
+    def getId(self):
+        return self.id
+
+    def getProjectId(self):
+        return self.project_id
+
+    def getRoles(self):
+        return self.roles
+
+    def getTrusteeUserId(self):
+        return self.trustee_user_id
+
+    def getTrustorUserId(self):
+        return self.trustor_user_id
+
+    def isImpersonation(self):
+        return self.impersonation
+
+    def toDict(self):
+        trust = {}
+        trust["id"] = self.id
+        trust["impersonation"] = self.impersonation
+        trust["project_id"] = self.project_id
+        trust["roles"] = self.roles
+        trust["trustee_user_id"] = self.trustee_user_id
+        trust["trustor_user_id"] = self.trustor_user_id
+        trust["expires_at"] = None
+
+        if self.expires_at is not None:
+            trust["expires_at"] = self.expires_at.isoformat()
+
+        return {"trust": trust}
+
+
 class KeystoneClient(object):
 
     def __init__(self, auth_url, username, password,
@@ -199,7 +521,8 @@ class KeystoneClient(object):
                  project_name=None, project_domain_id=None,
                  project_domain_name="default", timeout=None,
                  default_trust_expiration=None,
-                 ca_cert=None):
+                 ca_cert=None, deadline=None, failure_cache=None,
+                 pool_size=None):
         self.auth_url = auth_url
         self.username = username
         self.password = password
@@ -211,19 +534,38 @@ class KeystoneClient(object):
         self.project_domain_name = project_domain_name
         self.ca_cert = ca_cert
         self.timeout = timeout
+        self.deadline = deadline
+        self.failure_cache = failure_cache
         self.token = None
+        self.session = requests.Session()
+        self._local = threading.local()
+        self._auth_lock = threading.RLock()
+
+        if pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                    pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
 
         if default_trust_expiration:
             self.default_trust_expiration = default_trust_expiration
         else:
             self.default_trust_expiration = 24
 
+    @operation
     def authenticate(self):
+        with self._auth_lock:
+            self._authenticate()
+
+    def _authenticate(self):
         if self.token is not None:
             if self.token.isExpired():
+                # best-effort cleanup: it may use only half of what is left
+                # of the budget, which is needed for the authentication
                 try:
-                    self.deleteToken(self.token.getId())
-                except requests.exceptions.HTTPError:
+                    self._deleteToken(self.token.getId(), share=0.5)
+                except (requests.exceptions.RequestException,
+                        DeadlineExceeded):
                     pass
             else:
                 return
@@ -259,14 +601,25 @@ class KeystoneClient(object):
         if self.project_id:
             data["auth"]["scope"] = {"project": {"id": self.project_id,
                                                  "domain": project_domain}}
-        response = requests.post(url=self.auth_url + "/auth/tokens",
-                                 headers=headers,
-                                 data=json.dumps(data),
-                                 timeout=self.timeout,
-                                 verify=self.ca_cert)
+        if self.failure_cache is not None:
+            failure_key = self._getFailureKey()
+            self.failure_cache.check(failure_key)
 
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
+        try:
+            response = self._send("POST", self.auth_url + "/auth/tokens",
+                                  headers=headers,
+                                  data=json.dumps(data))
+
+            if response.status_code != requests.codes.ok:
+                response.raise_for_status()
+        except Exception as ex:
+            if self.failure_cache is not None and \
+                    FailureCache.isCacheable(ex):
+                self.failure_cache.failure(failure_key, ex)
+            raise
+
+        if self.failure_cache is not None:
+            self.failure_cache.success(failure_key)
 
         if not response.text:
             raise Exception("authentication failed!")
@@ -278,6 +631,7 @@ class KeystoneClient(object):
 
         self.token = Token(token_subject, token_data)
 
+    @operation
     def getUser(self, id):
         try:
             response = self.getResource("users/%s" % id, "GET")
@@ -291,6 +645,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getUsers(self):
         try:
             response = self.getResource("users", "GET")
@@ -304,6 +659,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getUserProjects(self, id):
         try:
             response = self.getResource("users/%s/projects" % id, "GET")
@@ -317,6 +673,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getUserRoles(self, user_id, project_id):
         try:
             response = self.getResource("/projects/%s/users/%s/roles"
@@ -333,6 +690,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getProject(self, id):
         try:
             response = self.getResource("/projects/%s" % id, "GET")
@@ -346,6 +704,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getProjects(self):
         try:
             response = self.getResource("/projects", "GET")
@@ -359,6 +718,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getRole(self, id):
         try:
             response = self.getResource("/roles/%s" % id, "GET")
@@ -372,6 +732,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getRoles(self):
         try:
             response = self.getResource("/roles", "GET")
@@ -385,11 +746,17 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getToken(self):
-        self.authenticate()
-        return self.token
+        with self._auth_lock:
+            self._authenticate()
+            return self.token
 
+    @operation
     def deleteToken(self, id):
+        self._deleteToken(id)
+
+    def _deleteToken(self, id, share=1.0):
         if self.token is None:
             return
 
@@ -400,28 +767,29 @@ class KeystoneClient(object):
                    "X-Auth-Token": self.token.getId(),
                    "X-Subject-Token": id}
 
-        response = requests.delete(url=self.auth_url + "/auth/tokens",
-                                   headers=headers,
-                                   timeout=self.timeout)
-
-        self.token = None
+        try:
+            response = self._send("DELETE", self.auth_url + "/auth/tokens",
+                                  share=share,
+                                  headers=headers)
+        finally:
+            self.token = None
 
         if response.status_code != requests.codes.ok:
             response.raise_for_status()
 
+    @operation
     def validateToken(self, id):
-        self.authenticate()
+        token = self.getToken()
 
         headers = {"Content-Type": "application/json",
                    "Accept": "application/json",
                    "User-Agent": "python-novaclient",
-                   "X-Auth-Project-Id": self.token.getProject()["name"],
-                   "X-Auth-Token": self.token.getId(),
+                   "X-Auth-Project-Id": token.getProject()["name"],
+                   "X-Auth-Token": token.getId(),
                    "X-Subject-Token": id}
 
-        response = requests.get(url=self.auth_url + "/auth/tokens",
-                                headers=headers,
-                                timeout=self.timeout)
+        response = self._send("GET", self.auth_url + "/auth/tokens",
+                              headers=headers)
 
         if response.status_code != requests.codes.ok:
             response.raise_for_status()
@@ -434,6 +802,7 @@ class KeystoneClient(object):
 
         return Token(token_subject, token_data)
 
+    @operation
     def getEndpoint(self, id=None, service_id=None):
         if id:
             try:
@@ -462,6 +831,7 @@ class KeystoneClient(object):
 
         return None
 
+    @operation
     def getEndpoints(self):
         try:
             response = self.getResource("/endpoints", "GET")
@@ -475,6 +845,7 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getService(self, id=None, name=None):
         if id:
             try:
@@ -497,6 +868,7 @@ class KeystoneClient(object):
 
         return None
 
+    @operation
     def getServices(self):
         try:
             response = self.getResource("/services", "GET")
@@ -510,47 +882,26 @@ class KeystoneClient(object):
 
         return response
 
+    @operation
     def getResource(self, resource, method, data=None):
-        self.authenticate()
+        token = self.getToken()
 
         url = self.auth_url + "/" + resource
 
         headers = {"Content-Type": "application/json",
                    "Accept": "application/json",
                    "User-Agent": "python-novaclient",
-                   "X-Auth-Project-Id": self.token.getProject()["name"],
-                   "X-Auth-Token": self.token.getId()}
+                   "X-Auth-Project-Id": token.getProject()["name"],
+                   "X-Auth-Token": token.getId()}
 
         if method == "GET":
-            response = requests.get(url,
-                                    headers=headers,
-                                    params=data,
-                                    timeout=self.timeout,
-                                    verify=self.ca_cert)
-        elif method == "POST":
-            response = requests.post(url,
-                                     headers=headers,
-                                     data=json.dumps(data),
-                                     timeout=self.timeout,
-                                     verify=self.ca_cert)
-        elif method == "PUT":
-            response = requests.put(url,
-                                    headers=headers,
-                                    data=json.dumps(data),
-                                    timeout=self.timeout,
-                                    verify=self.ca_cert)
-        elif method == "HEAD":
-            response = requests.head(url,
-                                     headers=headers,
-                                     data=json.dumps(data),
-                                     timeout=self.timeout,
-                                     verify=self.ca_cert)
-        elif method == "DELETE":
-            response = requests.delete(url,
-                                       headers=headers,
-                                       data=json.dumps(data),
-                                       timeout=self.timeout,
-                                       verify=self.ca_cert)
+            response = self._send(method, url,
+                                  headers=headers,
+                                  params=data)
+        elif method in ("POST", "PUT", "HEAD", "DELETE"):
+            response = self._send(method, url,
+                                  headers=headers,
+                                  data=json.dumps(data))
         else:
             raise Exception("wrong HTTP method: %s" % method)
 
@@ -562,6 +913,442 @@ class KeystoneClient(object):
         else:
             return None
 
+    @operation
+    def createTrust(self, trustee_user, expires_at=None, project_id=None,
+                    roles=None, impersonation=True):
+        token = self.getToken()
+
+        try:
+            return token.trust(trustee_user,
+                               expires_at=expires_at,
+                               project_id=project_id,
+                               roles=roles,
+                               impersonation=impersonation,
+                               timeout=self._getTimeout(),
+                               ca_cert=self.ca_cert,
+                               session=self.session)
+        except requests.exceptions.Timeout:
+            self._checkDeadline()
+            raise
+
+    def _getFailureKey(self):
+        password = hashlib.sha256(self.password.encode("utf-8")).hexdigest()
+
+        return FailureCache.getKey(self.auth_url,
+                                   self.user_domain_id,
+                                   self.user_domain_name,
+                                   self.username,
+                                   password,
+                                   self.project_id,
+                                   self.project_name,
+                                   self.project_domain_id,
+                                   self.project_domain_name)
+
+    def _getDeadline(self):
+        return getattr(self._local, "deadline", None)
+
+    def _getTimeout(self, share=1.0):
+        """Returns the timeout of the next HTTP call: at most the given share
+        of what is left of the deadline, if any.
+        """
+        deadline = self._getDeadline()
+
+        if deadline is None:
+            return self.timeout
+
+        timeout = deadline.remaining() * share
+
+        if self.timeout is not None:
+            timeout = min(self.timeout, timeout)
+
+        return deadline.getTimeout(timeout)
+
+    def _send(self, method, url, share=1.0, **kwargs):
+        try:
+            return self.session.request(method, url,
+                                        timeout=self._getTimeout(share),
+                                        verify=self.ca_cert,
+                                        **kwargs)
+        except requests.exceptions.Timeout:
+            self._checkDeadline()
+            raise
+
+    def _checkDeadline(self):
+        """Called when a request timed out: raises DeadlineExceeded if the
+        timeout was due to the deadline.
+        """
+        deadline = self._getDeadline()
+
+        if deadline is not None and deadline.isExpired():
+            raise DeadlineExceeded("deadline of %ss exceeded!"
+                                   % deadline.budget, timed_out=True)
+
+
+class SnapshotFile(object):
+    """Name <-> id index of a single Keystone collection, memory-mapped.
+
+    Layout (little-endian): a header (magic, version, number of entries,
+    fingerprint of the content, number of hash slots, size of the strings
+    area), the entries table
+    (offset and length of the id and of the name of each entry), the id
+    and the name hash tables (open addressing, entry index + 1 or 0 when
+    empty) and finally the UTF-8 strings.
+    """
+
+    MAGIC = b"KSSNAP\0\0"
+    VERSION = 2
+    HEADER = struct.Struct("<8sHHI32sII")
+    ENTRY = struct.Struct("<IIII")
+    SLOT = struct.Struct("<I")
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            # an empty file cannot be mapped
+            if os.fstat(f.fileno()).st_size < self.HEADER.size:
+                raise Exception("wrong snapshot file: %r" % filename)
+
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = self.readHeader(self.data, len(self.data))
+
+        if header is None:
+            self.data.close()
+            raise Exception("wrong snapshot file: %r" % filename)
+
+        self.count, self.fingerprint, self.slots = header
+        self.entries = self.HEADER.size
+        self.id_slots = self.entries + self.count * self.ENTRY.size
+        self.name_slots = self.id_slots + self.slots * self.SLOT.size
+        self.strings = self.name_slots + self.slots * self.SLOT.size
+
+    def close(self):
+        self.data.close()
+
+    def getId(self, name):
+        ids = self.getIds(name)
+
+        if len(ids) > 1:
+            raise Exception("ambiguous name %r: %s" % (name, ", ".join(ids)))
+
+        return ids[0] if ids else None
+
+    def getIds(self, name):
+        return [self._getString(index, 0)
+                for index in self._find(self.name_slots, 2, name)]
+
+    def getName(self, id):
+        for index in self._find(self.id_slots, 0, id):
+            return self._getString(index, 2)
+
+        return None
+
+    def _find(self, table, field, key):
+        if not self.slots:
+            return
+
+        key = key.encode("utf-8")
+        mask = self.slots - 1
+        slot = zlib.crc32(key) & mask
+
+        while True:
+            index = self.SLOT.unpack_from(self.data,
+                                          table + slot * self.SLOT.size)[0]
+            if not index:
+                return
+
+            if self._getBytes(index - 1, field) == key:
+                yield index - 1
+
+            slot = (slot + 1) & mask
+
+    def _getBytes(self, index, field):
+        entry = self.ENTRY.unpack_from(self.data,
+                                       self.entries + index * self.ENTRY.size)
+        offset = self.strings + entry[field]
+
+        if offset + entry[field + 1] > len(self.data):
+            raise Exception("corrupted snapshot file (entry %d)" % index)
+
+        return self.data[offset:offset + entry[field + 1]]
+
+    def _getString(self, index, field):
+        return self._getBytes(index, field).decode("utf-8")
+
+    @classmethod
+    def readHeader(cls, data, size):
+        """Returns the header read from data, or None if it is not valid
+        or if it does not match a file of the given size.
+        """
+        if len(data) < cls.HEADER.size:
+            return None
+
+        magic, version, _, count, fingerprint, slots, strings_size = \
+            cls.HEADER.unpack_from(data)
+
+        if magic != cls.MAGIC or version != cls.VERSION:
+            return None
+
+        # the hash tables need a power of two slots with at least one empty
+        if not slots or slots & (slots - 1) or count >= slots:
+            return None
+
+        # a truncated (or extended) file is not valid
+        if size != cls.HEADER.size + count * cls.ENTRY.size + \
+                2 * slots * cls.SLOT.size + strings_size:
+            return None
+
+        return count, fingerprint, slots
+
+    @classmethod
+    def getFingerprint(cls, items):
+        data = json.dumps(sorted(items), separators=(",", ":"))
+        return hashlib.sha256(data.encode("utf-8")).digest()
+
+    @classmethod
+    def write(cls, filename, items, fingerprint):
+        slots = 1
+        while slots < len(items) * 2:
+            slots *= 2
+
+        entries = []
+        strings = bytearray()
+        id_slots = [0] * slots
+        name_slots = [0] * slots
+
+        for index, (id, name) in enumerate(items):
+            id = id.encode("utf-8")
+            name = name.encode("utf-8")
+
+            entries.append(cls.ENTRY.pack(len(strings), len(id),
+                                          len(strings) + len(id), len(name)))
+            strings += id + name
+
+            for table, key in ((id_slots, id), (name_slots, name)):
+                slot = zlib.crc32(key) & (slots - 1)
+
+                while table[slot]:
+                    slot = (slot + 1) & (slots - 1)
+
+                table[slot] = index + 1
+
+        directory = os.path.dirname(filename) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory)
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0,
+                                        len(items), fingerprint, slots,
+                                        len(strings)))
+                f.write(b"".join(entries))
+                f.write(struct.pack("<%dI" % slots, *id_slots))
+                f.write(struct.pack("<%dI" % slots, *name_slots))
+                f.write(bytes(strings))
+
+            # readers keep on using the file they have already mapped
+            os.rename(tmp, filename)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+class DirectorySnapshot(object):
+    """On-disk snapshot of the Keystone collections, for offline lookups.
+
+    Each collection is stored in its own SnapshotFile, mapped in memory the
+    first time it is used, so that a name <-> id lookup costs neither a
+    call to Keystone nor parsing JSON.
+    """
+
+    # collection name, KeystoneClient method, field used as name
+    COLLECTIONS = (("users", "getUsers", "name"),
+                   ("projects", "getProjects", "name"),
+                   ("roles", "getRoles", "name"),
+                   ("services", "getServices", "name"),
+                   ("endpoints", "getEndpoints", "url"))
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+
+    def close(self):
+        for snapshot_file in self.files.values():
+            snapshot_file.close()
+
+        self.files = {}
+
+    def getId(self, collection, name):
+        return self._getFile(collection).getId(name)
+
+    def getIds(self, collection, name):
+        return self._getFile(collection).getIds(name)
+
+    def getName(self, collection, id):
+        return self._getFile(collection).getName(id)
+
+    def refresh(self, client):
+        """Exports the collections retrieved through the given client and
+        rewrites only the ones changed since the last export. Returns the
+        names of the rewritten collections.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        updated = []
+
+        for collection, method, field in self.COLLECTIONS:
+            items = [(item["id"], item.get(field) or "")
+                     for item in getattr(client, method)() or []]
+
+            fingerprint = SnapshotFile.getFingerprint(items)
+            filename = self._getFilename(collection)
+
+            if self._getFingerprint(filename) == fingerprint:
+                continue
+
+            SnapshotFile.write(filename, items, fingerprint)
+            updated.append(collection)
+
+            if collection in self.files:
+                self.files.pop(collection).close()
+
+        return updated
+
+    def _getFilename(self, collection):
+        return os.path.join(self.directory, "%s.snap" % collection)
+
+    def _getFile(self, collection):
+        if collection not in self.files:
+            if collection not in [c[0] for c in self.COLLECTIONS]:
+                raise Exception("wrong collection: %r" % collection)
+
+            filename = self._getFilename(collection)
+
+            if not os.path.isfile(filename):
+                raise Exception("snapshot of %r not found!" % collection)
+
+            self.files[collection] = SnapshotFile(filename)
+
+        return self.files[collection]
+
+    def _getFingerprint(self, filename):
+        try:
+            with open(filename, "rb") as f:
+                header = SnapshotFile.readHeader(
+                    f.read(SnapshotFile.HEADER.size),
+                    os.fstat(f.fileno()).st_size)
+        except (IOError, OSError):
+            return None
+
+        return header[1] if header else None
+
+
+def _parseTime(value):
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+
+    raise Exception("wrong time format (expected ISO 8601 UTC): %r" % value)
+
+
+def _createTrust(client, trustee_user, expires_at=None, project_id=None,
+                 roles=None, impersonation=True):
+    if expires_at is not None:
+        expires_at = _parseTime(expires_at)
+
+    return client.createTrust(trustee_user,
+                              expires_at=expires_at,
+                              project_id=project_id,
+                              roles=roles,
+                              impersonation=impersonation).toDict()
+
+
+# the operations allowed in batch mode: each input line is a JSON object
+# like {"id": "1", "op": "getUser", "args": {"id": "<user-id>"}} and the
+# "args" are passed as keyword arguments to the corresponding function
+BATCH_OPERATIONS = {
+    "getUser": lambda client, **args: client.getUser(**args),
+    "getUserProjects": lambda client, **args: client.getUserProjects(**args),
+    "getUserRoles": lambda client, **args: client.getUserRoles(**args),
+    "getRoles": lambda client, **args: client.getRoles(**args),
+    "validateToken":
+        lambda client, **args: client.validateToken(**args).toDict(),
+    "createTrust": _createTrust}
+
+
+def _runOperation(client, line):
+    request_id = None
+
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+
+        if request.get("op") not in BATCH_OPERATIONS:
+            raise Exception("wrong operation: %r" % request.get("op"))
+
+        function = BATCH_OPERATIONS[request["op"]]
+        result = function(client, **request.get("args", {}))
+
+        return {"id": request_id, "result": result}
+    except Exception as ex:
+        return {"id": request_id, "error": "%s" % ex}
+
+
+def runBatch(client, input, output, workers=8):
+    """Runs the JSONL operations read from input concurrently on the given
+    client and writes their results to output as JSONL, in the input order.
+    """
+    # only needed in batch mode: keep it off the credential plugin path
+    from concurrent.futures import ThreadPoolExecutor
+
+    pending = collections.deque()
+    condition = threading.Condition()
+    errors = []
+
+    def drain(future):
+        # called as each operation completes: writes the results at the head
+        # of the queue as soon as they are ready, without waiting for input
+        with condition:
+            try:
+                while not errors and pending and pending[0].done():
+                    output.write(json.dumps(pending.popleft().result()) +
+                                 "\n")
+                    output.flush()
+            except Exception as ex:
+                # e.g. a closed stdout: the reader stops and re-raises it
+                errors.append(ex)
+            finally:
+                condition.notify_all()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # readline() instead of iterating, so that each line is submitted
+        # as soon as it has been written
+        for line in iter(input.readline, ""):
+            if not line.strip():
+                continue
+
+            with condition:
+                while not errors and len(pending) >= workers * 2:
+                    condition.wait()
+
+                if errors:
+                    break
+
+                future = executor.submit(_runOperation, client, line)
+                pending.append(future)
+
+            future.add_done_callback(drain)
+
+        if errors:
+            for future in list(pending):
+                future.cancel()
+
+    if errors:
+        raise errors[0]
 
 
 def main():
@@ -652,6 +1439,63 @@ def main():
                             help="Specify a CA bundle file to use in verifying"
                                  " a TLS (https) server certificate. Defaults "
                                  "to env[OS_CACERT]")
+
+        parser.add_argument("--os-timeout",
+                            metavar="<seconds>",
+                            type=float,
+                            default=os.environ.get("OS_TIMEOUT", None),
+                            help="timeout of each HTTP request to Keystone. "
+                                 "Defaults to env[OS_TIMEOUT]")
+
+        parser.add_argument("--os-deadline",
+                            metavar="<seconds>",
+                            type=float,
+                            default=os.environ.get("OS_DEADLINE", 10),
+                            help="overall time budget of each Keystone "
+                                 "operation, including the authentication. "
+                                 "It must be lower than the kubectl "
+                                 "request timeout; 0 disables it. Note that "
+                                 "the HTTP timeouts apply to each connect "
+                                 "and read step, so a response trickling in "
+                                 "slowly may still exceed the budget. "
+                                 "Defaults to env[OS_DEADLINE] or 10")
+
+        parser.add_argument("--os-auth-failure-cache",
+                            metavar="<directory>",
+                            default=os.environ.get(
+                                "OS_AUTH_FAILURE_CACHE",
+                                os.path.join("~", ".cache",
+                                             "keystone_client")),
+                            help="directory where the authentication "
+                                 "failures are cached in order to back off "
+                                 "further attempts. An empty value disables "
+                                 "the cache. Defaults to "
+                                 "env[OS_AUTH_FAILURE_CACHE] or "
+                                 "~/.cache/keystone_client")
+
+        parser.add_argument("--batch",
+                            default=False,
+                            action="store_true",
+                            help="read the Keystone operations as JSONL from "
+                                 "stdin and write their results as JSONL to "
+                                 "stdout, instead of printing the "
+                                 "ExecCredential")
+
+        parser.add_argument("--batch-workers",
+                            metavar="<workers>",
+                            type=int,
+                            default=8,
+                            help="number of operations run concurrently in "
+                                 "batch mode. Defaults to 8")
+
+        parser.add_argument("--export-snapshot",
+                            metavar="<directory>",
+                            default=None,
+                            help="export the users, projects, roles, "
+                                 "services and endpoints to an indexed "
+                                 "snapshot in the given directory, rewriting "
+                                 "only the collections changed since the "
+                                 "last export")
         """
         parser.add_argument("--insecure",
                             default=os.environ.get("INSECURE", False),
@@ -676,6 +1520,9 @@ def main():
         os_auth_token_cache = args.os_auth_token_cache
         os_auth_url = args.os_auth_url
         os_ca_cert = args.os_ca_cert
+        os_timeout = args.os_timeout
+        os_deadline = args.os_deadline
+        os_auth_failure_cache = args.os_auth_failure_cache
         bypass_url = args.bypass_url
 
         if not os_username:
@@ -696,6 +1543,11 @@ def main():
         if not os_project_domain_name:
             os_project_domain_name = "default"
 
+        failure_cache = None
+        if os_auth_failure_cache:
+            failure_cache = FailureCache(
+                os.path.expanduser(os_auth_failure_cache))
+
         client = KeystoneClient(
             auth_url=os_auth_url,
             username=os_username,
@@ -705,8 +1557,21 @@ def main():
             project_name=os_project_name,
             project_domain_id=os_project_domain_id,
             project_domain_name=os_project_domain_name,
+            timeout=os_timeout,
+            deadline=os_deadline,
+            failure_cache=failure_cache,
+            pool_size=args.batch_workers if args.batch else None,
             ca_cert=os_ca_cert)
 
+        if args.export_snapshot:
+            snapshot = DirectorySnapshot(args.export_snapshot)
+            print(json.dumps({"updated": snapshot.refresh(client)}))
+            return
+
+        if args.batch:
+            client.authenticate()
+            runBatch(client, sys.stdin, sys.stdout, args.batch_workers)
+            return
 
         client.authenticate()
         token = client.getToken()
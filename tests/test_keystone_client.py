@@ -0,0 +1,449 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "roles",
+                                "auth", "keystone", "files"))
+
+import keystone_client  # noqa: E402
+import requests  # noqa: E402
+
+
+def makeToken(expires_at="2099-01-01T00:00:00.000000Z"):
+    return {"token": {"roles": [{"id": "r1", "name": "admin"}],
+                      "catalog": [],
+                      "issued_at": "2020-01-01T00:00:00.000000Z",
+                      "expires_at": expires_at,
+                      "project": {"id": "p1", "name": "project"},
+                      "user": {"id": "u1", "name": "user"}}}
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubResponse(object):
+
+    def __init__(self, data, headers=None, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(data)
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        raise requests.exceptions.HTTPError(response=self)
+
+
+class StubSession(object):
+    """Session recording the timeout of each request: every request takes
+    `elapsed` seconds on the clock, while the ones whose method is in
+    `timed_out` use their whole timeout and then time out.
+    """
+
+    def __init__(self, clock, elapsed, timed_out=()):
+        self.clock = clock
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+        self.requests = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.requests.append((method, timeout))
+
+        if method in self.timed_out:
+            self.clock.now += timeout
+            raise requests.exceptions.Timeout()
+
+        self.clock.now += self.elapsed
+
+        if url.endswith("/auth/tokens"):
+            return StubResponse(makeToken(), {"X-Subject-Token": "new"})
+
+        return StubResponse({"users": []})
+
+
+class FakeClient(object):
+
+    def getUser(self, id):
+        # still running when the reader goes back to reading the input
+        time.sleep(0.1)
+        return {"id": id}
+
+
+class LineOutput(io.StringIO):
+    """Output stream signalling each line written by runBatch()."""
+
+    def __init__(self):
+        io.StringIO.__init__(self)
+        self.written = threading.Event()
+
+    def flush(self):
+        io.StringIO.flush(self)
+        self.written.set()
+
+
+class BrokenOutput(io.StringIO):
+    """Output stream behaving like a closed pipe."""
+
+    def write(self, data):
+        raise BrokenPipeError(32, "Broken pipe")
+
+
+class RunBatchTest(unittest.TestCase):
+
+    def test_result_streamed_before_eof(self):
+        read_fd, write_fd = os.pipe()
+        input = os.fdopen(read_fd, "r")
+        writer = os.fdopen(write_fd, "w")
+        output = LineOutput()
+
+        batch = threading.Thread(target=keystone_client.runBatch,
+                                 args=(FakeClient(), input, output, 2))
+        batch.start()
+
+        try:
+            # stdin is held open: the result must not wait for more input
+            writer.write(json.dumps({"id": "1", "op": "getUser",
+                                     "args": {"id": "u1"}}) + "\n")
+            writer.flush()
+
+            self.assertTrue(output.written.wait(5))
+            self.assertEqual([{"id": "1", "result": {"id": "u1"}}],
+                             [json.loads(line) for line
+                              in output.getvalue().splitlines()])
+        finally:
+            writer.close()
+            batch.join(5)
+            input.close()
+
+        self.assertFalse(batch.is_alive())
+
+    def test_results_in_input_order(self):
+        lines = [json.dumps({"id": i, "op": "getUser",
+                             "args": {"id": "u%d" % i}}) for i in range(20)]
+        lines.append(json.dumps({"id": "x", "op": "wrong"}))
+        output = LineOutput()
+
+        keystone_client.runBatch(FakeClient(),
+                                 io.StringIO("\n".join(lines) + "\n"),
+                                 output, 4)
+
+        results = [json.loads(line)
+                   for line in output.getvalue().splitlines()]
+
+        self.assertEqual(list(range(20)) + ["x"],
+                         [result["id"] for result in results])
+        self.assertEqual("wrong operation: 'wrong'", results[-1]["error"])
+
+    def test_write_error_stops_the_batch(self):
+        lines = [json.dumps({"id": i, "op": "getUser",
+                             "args": {"id": "u%d" % i}}) for i in range(50)]
+        errors = []
+
+        def run():
+            try:
+                keystone_client.runBatch(FakeClient(),
+                                         io.StringIO("\n".join(lines) + "\n"),
+                                         BrokenOutput(), 2)
+            except Exception as ex:
+                errors.append(ex)
+
+        batch = threading.Thread(target=run)
+        batch.start()
+        batch.join(5)
+
+        self.assertFalse(batch.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], BrokenPipeError)
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.saved_clock = keystone_client._clock
+        keystone_client._clock = self.clock
+
+    def tearDown(self):
+        keystone_client._clock = self.saved_clock
+
+    def makeClient(self, session, deadline=10, timeout=None):
+        client = keystone_client.KeystoneClient("http://keystone/v3",
+                                                "user", "password",
+                                                project_name="project",
+                                                timeout=timeout,
+                                                deadline=deadline)
+        client.session = session
+        return client
+
+    def test_budget_shared_across_nested_calls(self):
+        session = StubSession(self.clock, 3)
+
+        self.makeClient(session).getUsers()
+
+        self.assertEqual([("POST", 10), ("GET", 7)], session.requests)
+
+    def test_request_timeout_within_budget(self):
+        session = StubSession(self.clock, 3)
+
+        self.makeClient(session, timeout=2).getUsers()
+
+        self.assertEqual([("POST", 2), ("GET", 2)], session.requests)
+
+    def test_expired_token_delete_gets_half_of_budget(self):
+        session = StubSession(self.clock, 3)
+        client = self.makeClient(session)
+        client.token = keystone_client.Token(
+            "old", makeToken("2000-01-01T00:00:00.000000Z"))
+
+        client.getUsers()
+
+        self.assertEqual([("DELETE", 5), ("POST", 7), ("GET", 4)],
+                         session.requests)
+
+    def test_slow_delete_does_not_prevent_authentication(self):
+        session = StubSession(self.clock, 1, timed_out=("DELETE",))
+        client = self.makeClient(session)
+        client.token = keystone_client.Token(
+            "old", makeToken("2000-01-01T00:00:00.000000Z"))
+
+        client.authenticate()
+
+        self.assertEqual([("DELETE", 5), ("POST", 5)], session.requests)
+        self.assertEqual("new", client.token.getId())
+
+    def test_timeout_converted_to_deadline_exceeded(self):
+        session = StubSession(self.clock, 1, timed_out=("POST",))
+
+        with self.assertRaises(keystone_client.DeadlineExceeded) as cm:
+            self.makeClient(session).getUsers()
+
+        self.assertTrue(cm.exception.timed_out)
+
+    def test_zero_deadline_disables_budget(self):
+        session = StubSession(self.clock, 3)
+
+        self.makeClient(session, deadline=0).getUsers()
+
+        self.assertEqual([("POST", None), ("GET", None)], session.requests)
+
+
+class FailureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = keystone_client.FailureCache(self.directory,
+                                                  min_backoff=1,
+                                                  max_backoff=4)
+        self.key = keystone_client.FailureCache.getKey("user", "password")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def loadEntry(self):
+        with open(self.cache._getFilename(self.key)) as f:
+            return json.load(f)
+
+    def saveEntry(self, entry):
+        with open(self.cache._getFilename(self.key), "w") as f:
+            json.dump(entry, f)
+
+    def test_backoff_grows_exponentially(self):
+        backoffs = []
+
+        for i in range(4):
+            self.cache.failure(self.key, "401 Unauthorized")
+            backoffs.append(self.loadEntry()["backoff"])
+
+        self.assertEqual([1, 2, 4, 4], backoffs)
+
+        with self.assertRaises(keystone_client.AuthenticationBackoff) as cm:
+            self.cache.check(self.key)
+
+        self.assertIn("401 Unauthorized", str(cm.exception))
+
+    def test_expired_backoff_claims_the_retry(self):
+        self.cache.failure(self.key, "503 Service Unavailable")
+        entry = self.loadEntry()
+        entry["retry_at"] = time.time() - 1
+        self.saveEntry(entry)
+
+        # the first check probes Keystone, the others keep backing off
+        self.cache.check(self.key)
+
+        with self.assertRaises(keystone_client.AuthenticationBackoff):
+            self.cache.check(self.key)
+
+    def test_success_clears_the_entry(self):
+        self.cache.failure(self.key, "401 Unauthorized")
+        self.cache.success(self.key)
+
+        self.cache.check(self.key)
+        self.assertEqual([".auth_failure.lock"], os.listdir(self.directory))
+
+    def test_cacheable_errors(self):
+        def httpError(status_code):
+            return requests.exceptions.HTTPError(
+                response=StubResponse({}, status_code=status_code))
+
+        isCacheable = keystone_client.FailureCache.isCacheable
+        DeadlineExceeded = keystone_client.DeadlineExceeded
+
+        for status_code in (401, 403, 429, 500, 503):
+            self.assertTrue(isCacheable(httpError(status_code)))
+
+        for status_code in (400, 404):
+            self.assertFalse(isCacheable(httpError(status_code)))
+
+        self.assertTrue(isCacheable(requests.exceptions.ConnectionError()))
+        self.assertTrue(isCacheable(requests.exceptions.Timeout()))
+        self.assertTrue(isCacheable(DeadlineExceeded("", timed_out=True)))
+        self.assertFalse(isCacheable(DeadlineExceeded("")))
+        self.assertFalse(isCacheable(ValueError()))
+
+    def test_unusable_directory_disables_the_cache(self):
+        filename = os.path.join(self.directory, "file")
+        open(filename, "w").close()
+
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            # the directory cannot be created
+            cache = keystone_client.FailureCache(
+                os.path.join(filename, "cache"))
+            self.assertFalse(cache.enabled)
+
+            # the directory exists but it is not usable
+            cache = keystone_client.FailureCache(filename)
+            cache.failure(self.key, "401 Unauthorized")
+            cache.check(self.key)
+            self.assertFalse(cache.enabled)
+
+        self.assertIn("cache disabled", stderr.getvalue())
+
+
+class FakeDirectoryClient(object):
+
+    def __init__(self):
+        self.users = [{"id": "u%d" % i, "name": "user%d" % i}
+                      for i in range(100)]
+        self.users.append({"id": "u\u00e9", "name": "n\u00e9"})
+        self.projects = [{"id": "p1", "name": "project"},
+                         {"id": "p2", "name": "project"}]
+
+    def getUsers(self):
+        return self.users
+
+    def getProjects(self):
+        return self.projects
+
+    def getRoles(self):
+        return []
+
+    def getServices(self):
+        return None
+
+    def getEndpoints(self):
+        return [{"id": "e1", "url": "https://keystone:5000/v3"}]
+
+
+class DirectorySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = FakeDirectoryClient()
+        self.snapshot = keystone_client.DirectorySnapshot(self.directory)
+
+        self.assertEqual(["users", "projects", "roles", "services",
+                          "endpoints"], self.snapshot.refresh(self.client))
+
+    def tearDown(self):
+        self.snapshot.close()
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        snapshot = keystone_client.DirectorySnapshot(self.directory)
+        self.addCleanup(snapshot.close)
+        return snapshot
+
+    def test_lookups(self):
+        snapshot = self.open()
+
+        for i in range(100):
+            self.assertEqual("u%d" % i, snapshot.getId("users", "user%d" % i))
+            self.assertEqual("user%d" % i, snapshot.getName("users",
+                                                            "u%d" % i))
+
+        self.assertEqual("u\u00e9", snapshot.getId("users", "n\u00e9"))
+        self.assertEqual("n\u00e9", snapshot.getName("users", "u\u00e9"))
+        self.assertEqual("e1", snapshot.getId("endpoints",
+                                              "https://keystone:5000/v3"))
+
+    def test_unknown_name(self):
+        snapshot = self.open()
+
+        self.assertIsNone(snapshot.getId("users", "unknown"))
+        self.assertIsNone(snapshot.getName("users", "unknown"))
+        self.assertEqual([], snapshot.getIds("users", "unknown"))
+
+    def test_duplicated_name(self):
+        snapshot = self.open()
+
+        self.assertEqual(["p1", "p2"],
+                         sorted(snapshot.getIds("projects", "project")))
+
+        with self.assertRaises(Exception) as cm:
+            snapshot.getId("projects", "project")
+
+        self.assertIn("ambiguous", str(cm.exception))
+
+    def test_empty_collection(self):
+        snapshot = self.open()
+
+        for collection in ("roles", "services"):
+            self.assertEqual(1, snapshot._getFile(collection).slots)
+            self.assertIsNone(snapshot.getId(collection, "admin"))
+            self.assertIsNone(snapshot.getName(collection, "r1"))
+
+    def test_refresh_rewrites_only_changed_collections(self):
+        self.assertEqual([], self.snapshot.refresh(self.client))
+
+        self.client.users = self.client.users[:10]
+
+        self.assertEqual(["users"], self.snapshot.refresh(self.client))
+
+        snapshot = self.open()
+        self.assertEqual("u9", snapshot.getId("users", "user9"))
+        self.assertIsNone(snapshot.getId("users", "user10"))
+
+    def test_refresh_rewrites_corrupted_files(self):
+        filename = os.path.join(self.directory, "users.snap")
+
+        with open(filename, "rb") as f:
+            data = f.read()
+
+        # cut inside the strings, inside the tables and empty
+        for size in (len(data) - 5, 100, 0):
+            with open(filename, "wb") as f:
+                f.write(data[:size])
+
+            with self.assertRaises(Exception):
+                self.open().getId("users", "user1")
+
+            self.assertEqual(["users"], self.snapshot.refresh(self.client))
+            self.assertEqual("u1", self.open().getId("users", "user1"))
+
+
+if __name__ == "__main__":
+    unittest.main()